@@ -1,5 +1,8 @@
 # High Level Analyzer
-from saleae.analyzers import HighLevelAnalyzer, AnalyzerFrame, ChoicesSetting, NumberSetting
+import math
+from collections import deque
+
+from saleae.analyzers import HighLevelAnalyzer, AnalyzerFrame, ChoicesSetting, NumberSetting, StringSetting
 
 
 def check_bit(value, pos):
@@ -64,6 +67,139 @@ def f_status(bit):
     else:
         return "T"
 
+
+def parse_seconds(rule, value):
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise ValueError("Invalid time window in alert rule '" + rule + "'")
+    if not math.isfinite(seconds) or seconds <= 0:
+        raise ValueError("Time window must be a positive number in alert rule '" + rule + "'")
+    return seconds
+
+
+# Rules are separated by ';' and are compiled once into lookup tables, so every packet costs the same
+# no matter how many rules are loaded:
+#   <frame type>                  Alert on every packet of that type, e.g. short_circuit or emergency_stop
+#   speed > <n> / speed >= <n>    Alert on locomotive speed operations above the limit, compared to the decoded speed step
+#   turnout_unconfirmed <s>       Alert when an activated accessory output gets no information response within s seconds
+#   inquiry_missing <s>           Alert when a device that was inquired before is not inquired again within s seconds
+class AlertEngine:
+
+    def __init__(self, rules, known_frame_types):
+        self.known_frame_types = known_frame_types
+        self.frame_types = set()
+        self.speed_limit = None
+        self.speed_rule = None
+        self.turnout_window = None
+        self.inquiry_window = None
+
+        # Pending turnout operations: address -> time of the request, plus the requests in arrival order
+        self.pending_turnouts = {}
+        self.turnout_queue = deque()
+        # Inquired devices: address -> time of the last inquiry, plus all inquiries in arrival order
+        self.last_inquiry = {}
+        self.inquiry_queue = deque()
+
+        for rule in (rules or "").split(";"):
+            self.compile_rule(rule.strip())
+
+    def compile_rule(self, rule):
+        if not rule:
+            return
+        parts = rule.split()
+        if parts[0] == "speed":
+            if len(parts) != 3 or parts[1] not in (">", ">="):
+                raise ValueError("Invalid speed rule '" + rule + "', expected 'speed > <n>'")
+            try:
+                limit = int(parts[2])
+            except ValueError:
+                raise ValueError("Invalid speed limit in alert rule '" + rule + "'")
+            if parts[1] == ">=":
+                limit -= 1
+            # Only the lowest limit can ever decide whether an alert is raised
+            if self.speed_limit is None or limit < self.speed_limit:
+                self.speed_limit = limit
+                self.speed_rule = " ".join(parts)
+        elif parts[0] == "turnout_unconfirmed":
+            if len(parts) != 2:
+                raise ValueError("Invalid rule '" + rule + "', expected 'turnout_unconfirmed <seconds>'")
+            if self.turnout_window is not None:
+                raise ValueError("Only one turnout_unconfirmed rule is allowed")
+            self.turnout_window = parse_seconds(rule, parts[1])
+        elif parts[0] == "inquiry_missing":
+            if len(parts) != 2:
+                raise ValueError("Invalid rule '" + rule + "', expected 'inquiry_missing <seconds>'")
+            if self.inquiry_window is not None:
+                raise ValueError("Only one inquiry_missing rule is allowed")
+            self.inquiry_window = parse_seconds(rule, parts[1])
+        elif rule in self.known_frame_types:
+            self.frame_types.add(rule)
+        else:
+            raise ValueError("Unknown alert rule or packet type '" + rule + "'")
+
+    def alert(self, packet, rule, extra=""):
+        return AnalyzerFrame("alert", packet.start_time, packet.end_time, {"rule": rule, "extra": extra})
+
+    def process(self, packet):
+        alerts = []
+        if packet is None:
+            return alerts
+
+        if packet.type in self.frame_types:
+            alerts.append(self.alert(packet, packet.type))
+
+        if self.speed_limit is not None and packet.type == "locomotive_speed_and_direction_operation":
+            speed = packet.data["speed"]
+            # Emergency stop is decoded as text and stop as 0 for every speed step mode
+            if isinstance(speed, int) and speed > 0 and speed > self.speed_limit:
+                alerts.append(self.alert(packet, "speed", "Address=" + str(packet.data["address"]) + ", Speed=" + str(speed)
+                                         + ", Limit=" + self.speed_rule))
+
+        if self.turnout_window is not None:
+            self.track_turnouts(packet, alerts)
+
+        if self.inquiry_window is not None:
+            self.track_inquiries(packet, alerts)
+
+        return alerts
+
+    def track_turnouts(self, packet, alerts):
+        now = packet.end_time
+        # Expire first, so a late confirmation or repeated request still reports the missed window
+        # The window is the same for all requests, so the oldest request always expires first
+        while self.turnout_queue and float(now - self.turnout_queue[0][0]) > self.turnout_window:
+            requested, address = self.turnout_queue.popleft()
+            # Skip requests that were confirmed or repeated in the meantime
+            if self.pending_turnouts.get(address) == requested:
+                del self.pending_turnouts[address]
+                alerts.append(self.alert(packet, "turnout_unconfirmed", "Address=" + str(address)))
+
+        if packet.type == "accessory_decoder_operation_request" and packet.data["output_state"] == "Activate":
+            address = packet.data["address"]
+            self.pending_turnouts[address] = now
+            self.turnout_queue.append((now, address))
+        elif packet.type == "accessory_decoder_information_response" and \
+                packet.data["type"] in ("w/o feedback", "w/ feedback") and not packet.data["extra"]:
+            # Only completed responses of switching decoders confirm a turnout
+            self.pending_turnouts.pop(packet.data["first_address"], None)
+            self.pending_turnouts.pop(packet.data["second_address"], None)
+
+    def track_inquiries(self, packet, alerts):
+        now = packet.end_time
+        # Expire first, so a late inquiry of the same device still reports the missed window
+        while self.inquiry_queue and float(now - self.inquiry_queue[0][0]) > self.inquiry_window:
+            inquired, address = self.inquiry_queue.popleft()
+            # Only the latest inquiry of a device counts, the device is tracked again once it is inquired
+            if self.last_inquiry.get(address) == inquired:
+                del self.last_inquiry[address]
+                alerts.append(self.alert(packet, "inquiry_missing", "Address=" + str(address)))
+
+        if packet.type == "normal_inquiry":
+            address = packet.data["address"]
+            self.last_inquiry[address] = now
+            self.inquiry_queue.append((now, address))
+
 # High level analyzers must subclass the HighLevelAnalyzer class.
 class Hla(HighLevelAnalyzer):
     result_types = {
@@ -135,23 +271,47 @@ class Hla(HighLevelAnalyzer):
         'accessory_decoder_information_response': {
             'format': "Accessory Decoder response. Type={{data.type}} Addresses={{data.addresses}} {{data.extra}}"
         },
-    }
 
-    show_inquiry_packets = ChoicesSetting(choices=("Yes", "No"))
+        # Alerts raised by the alert rules
+        'alert': {
+            'format': "ALERT {{data.rule}} {{data.extra}}"
+        },
+    }
 
-    address = 0
-    in_packet = False
-    has_header = False
-    started_with_call_byte = False
-    start_time = 0
-    end_time = 0
-    packet_size = 0
+    # Packet types that are decoded without an entry in result_types
+    other_frame_types = {
+        "Emergency Stop Loco",
+        "Function F0-F12 Status Response",
+        "Function F13-F28 Info Response",
+        "Function F13-F28 Status Response",
+        "Loco operated by another device",
+        "Request Function F0-F12 Status",
+        "Request Function F13-F28 Information",
+        "Request Function F13-F28 Status",
+        "Request Locomotive Information",
+        "Set Function F0-F4 Status",
+        "Set Function F5-F8 Status",
+        "Set Function F9-F12 Status",
+        "Set Function F13-F20 Status",
+        "Set Function F21-F28 Status",
+        "locomotive Information Response",
+    }
 
-    packet_data = []
-    client_header_map = {}
-    station_header_map = {}
+    show_inquiry_packets = ChoicesSetting(choices=("Yes", "No"))
+    alert_rules = StringSetting(label="Alert rules (e.g. short_circuit; speed > 100; inquiry_missing 1)")
 
     def __init__(self):
+        # Decoder state is kept per instance instead of on the class.
+        # packet_data is replaced whenever a new packet starts, so it never holds more than one packet.
+        self.address = 0
+        self.in_packet = False
+        self.has_header = False
+        self.started_with_call_byte = False
+        self.start_time = 0
+        self.end_time = 0
+        self.packet_size = 0
+        self.packet_data = []
+
         self.client_header_map = {
             0x20: self.acknowledgment_response,
             0x21: self.generic_request,
@@ -169,10 +329,23 @@ class Hla(HighLevelAnalyzer):
             0x62: self.station_status,
             0x63: self.station_software_version,
         }
-        pass
+        known_frame_types = (set(self.result_types) | self.other_frame_types) - {"alert"}
+        self.alert_engine = AlertEngine(self.alert_rules, known_frame_types)
 
-    # TODO add checks for parity and xor
     def decode(self, frame: AnalyzerFrame):
+        packet = self.decode_packet(frame)
+        # Alert rules also see inquiry packets that are not shown
+        alerts = self.alert_engine.process(packet)
+        if packet and packet.type == "normal_inquiry" and self.show_inquiry_packets == "No":
+            packet = None
+        if alerts:
+            if packet:
+                return [packet] + alerts
+            return alerts
+        return packet
+
+    # TODO add checks for parity and xor
+    def decode_packet(self, frame: AnalyzerFrame):
         if frame.type != 'data':
             return
         if 'error' in frame.data:
@@ -188,8 +361,6 @@ class Hla(HighLevelAnalyzer):
             # Handle special cases
             special_case = self.handle_special_case(data, frame)
             if special_case:
-                if special_case.type == "normal_inquiry" and self.show_inquiry_packets == "No":
-                    return
                 return special_case
 
             # Handle broadcast or answer
@@ -329,7 +500,9 @@ class Hla(HighLevelAnalyzer):
             extra = "(Request has been not completed)"
 
         return AnalyzerFrame("accessory_decoder_information_response", self.start_time, self.end_time,
-                             {"type": type_name, "addresses": addresses, "extra": extra})
+                             {"type": type_name, "addresses": addresses, "extra": extra,
+                              "first_address": address_start + 2 * nibble,
+                              "second_address": address_start + 1 + 2 * nibble})
 
     def accessory_decoder_operation_request(self):
         address = (self.packet_data[1] * 4) + ((self.packet_data[2] >> 1) & 0b11)
@@ -427,9 +600,19 @@ class Hla(HighLevelAnalyzer):
 
         if self.packet_data[1] == 0x10:
             steps = 14
+            speed &= 0b00001111
+            if (speed == 1):
+                speed = "Emergency stop"
+            elif (speed > 1):
+                speed -= 1
         elif self.packet_data[1] == 0x11:
             steps = 27
-            if (speed > 0):
+            # Both 0b00000 and 0b10000 mean stop, 0b00001 and 0b10001 mean emergency stop
+            if (speed & 0b00001111) == 0:
+                speed = 0
+            elif (speed & 0b00001111) == 1:
+                speed = "Emergency stop"
+            else:
                 bit4 = ((speed & 0b00010000) >> 4)
                 speed &= 0b00001111
                 speed <<= 1
@@ -437,7 +620,11 @@ class Hla(HighLevelAnalyzer):
                 speed -= 3
         elif self.packet_data[1] == 0x12:
             steps = 28
-            if (speed > 0):
+            if (speed & 0b00001111) == 0:
+                speed = 0
+            elif (speed & 0b00001111) == 1:
+                speed = "Emergency stop"
+            else:
                 bit4 = ((speed & 0b00010000) >> 4)
                 speed &= 0b00001111
                 speed <<= 1
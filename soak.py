@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Soak test for the XpressNet decoder.
+# Feeds randomized and malformed 9-bit words through Hla.decode() and samples memory (tracemalloc)
+# and throughput at intervals. Exits with 1 when memory grows or throughput drops beyond the thresholds.
+#
+# Example: python soak.py --words 300000000 --interval 10000000
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+import types
+
+# XpressNet runs at 62.5 kbaud with 11 bits per 9-bit word (start, 9 data bits, stop)
+WORD_TIME = 11 / 62500
+
+
+def install_saleae_stub():
+    # saleae.analyzers only exists inside Logic 2, a minimal stand-in is enough to drive decode()
+    try:
+        import saleae.analyzers
+        return
+    except ImportError:
+        pass
+
+    class HighLevelAnalyzer:
+        pass
+
+    class AnalyzerFrame:
+        def __init__(self, type, start_time, end_time, data=None):
+            self.type = type
+            self.start_time = start_time
+            self.end_time = end_time
+            self.data = data or {}
+
+    def setting(**kwargs):
+        return None
+
+    saleae = types.ModuleType("saleae")
+    analyzers = types.ModuleType("saleae.analyzers")
+    analyzers.HighLevelAnalyzer = HighLevelAnalyzer
+    analyzers.AnalyzerFrame = AnalyzerFrame
+    analyzers.ChoicesSetting = setting
+    analyzers.NumberSetting = setting
+    analyzers.StringSetting = setting
+    saleae.analyzers = analyzers
+    sys.modules["saleae"] = saleae
+    sys.modules["saleae.analyzers"] = analyzers
+
+
+def random_packet(rnd):
+    # A well formed packet, optionally started by a broadcast/answer callbyte
+    header = rnd.choice((0x20, 0x21, 0x42, 0x52, 0x61, 0x62, 0x63, 0x81, 0x92, 0xE3, 0xE4, rnd.getrandbits(8)))
+    words = []
+    if rnd.random() < 0.5:
+        words.append(0x160 | rnd.getrandbits(5))
+    words.append(header)
+    words += [rnd.getrandbits(8) for _ in range((header & 0b1111) + 1)]
+    return words
+
+
+def random_words(rnd):
+    kind = rnd.random()
+    if kind < 0.4:
+        return random_packet(rnd)
+    if kind < 0.6:
+        # Inquiry and acknowledgement callbytes
+        return [0x100 | rnd.choice((0x40, 0x00)) | rnd.getrandbits(5)]
+    if kind < 0.8:
+        # Truncated packet
+        packet = random_packet(rnd)
+        return packet[:rnd.randrange(1, len(packet))]
+    # Random noise
+    return [rnd.getrandbits(9) for _ in range(rnd.randrange(1, 16))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test for the XpressNet decoder")
+    parser.add_argument("--words", type=int, default=10000000, help="Number of 9-bit words to decode")
+    parser.add_argument("--interval", type=int, default=1000000, help="Words between two samples")
+    parser.add_argument("--max-memory-growth", type=int, default=64 * 1024,
+                        help="Allowed memory growth in bytes compared to the first sample")
+    parser.add_argument("--max-throughput-drop", type=float, default=0.5,
+                        help="Allowed throughput drop as fraction of the first sample")
+    parser.add_argument("--setting", action="append", default=[], metavar="NAME=VALUE",
+                        help="Analyzer setting used while decoding, can be given multiple times")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    install_saleae_stub()
+    from saleae.analyzers import AnalyzerFrame
+    import HighLevelAnalyzer
+
+    # Logic 2 provides the settings as attributes before the analyzer is created
+    HighLevelAnalyzer.Hla.show_inquiry_packets = "Yes"
+    for setting in args.setting:
+        name, _, value = setting.partition("=")
+        setattr(HighLevelAnalyzer.Hla, name, value)
+    hla = HighLevelAnalyzer.Hla()
+    rnd = random.Random(args.seed)
+
+    tracemalloc.start()
+    base_memory = None
+    base_rate = None
+    failed = False
+    count = 0
+    next_sample = args.interval
+    sample_start = time.perf_counter()
+
+    while count < args.words:
+        for word in random_words(rnd):
+            start = count * WORD_TIME
+            frame = AnalyzerFrame("data", start, start + WORD_TIME, {"data": bytes((word >> 8, word & 0xFF))})
+            hla.decode(frame)
+            count += 1
+
+        if count >= next_sample:
+            now = time.perf_counter()
+            rate = args.interval / (now - sample_start)
+            memory, _ = tracemalloc.get_traced_memory()
+            if base_memory is None:
+                base_memory = memory
+                base_rate = rate
+
+            growth = memory - base_memory
+            drop = 1 - rate / base_rate
+            print("%d words: memory=%d (%+d) rate=%.0f words/s (%+.1f%%)" % (count, memory, growth, rate, -drop * 100))
+            if growth > args.max_memory_growth:
+                print("FAIL: memory grew by %d bytes" % growth)
+                failed = True
+            if drop > args.max_throughput_drop:
+                print("FAIL: throughput dropped by %.1f%%" % (drop * 100))
+                failed = True
+
+            next_sample += args.interval
+            sample_start = time.perf_counter()
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())